@@ -0,0 +1,64 @@
+import numpy as np
+
+
+COMPILED_MODEL_PATH = './trained_models/compiled_XGBoost_model.npz'
+
+
+def load_compiled_model(compiled_filepath=COMPILED_MODEL_PATH):
+    """
+    Takes the filepath of an exported model and returns its arrays in a dictionary.
+    Only needs NumPy, so predictions can be served without xgboost, sklearn or imblearn
+    """
+    with np.load(compiled_filepath, allow_pickle=False) as f:
+        compiled_model = {name: f[name] for name in f.files}
+    return compiled_model
+
+def prep_rows_for_compiled_model(compiled_model, gameweek_data):
+    """
+    Takes gameweek data (a dataframe or a dictionary of column name to values) and
+    returns the float32 feature matrix the model expects, one-hot encoding the
+    categorical columns with the categories the model was trained with
+    """
+    columns = []
+    for name, encoded_column, category in zip(compiled_model['column_names'], compiled_model['encoded_columns'], compiled_model['encoded_categories']):
+        if encoded_column:
+            values = np.asarray(gameweek_data[str(encoded_column)], dtype=np.float64)
+            columns.append(values == category)
+        else:
+            columns.append(np.asarray(gameweek_data[str(name)], dtype=np.float64))
+    return np.column_stack(columns).astype(np.float32)
+
+def predict_margin(compiled_model, features):
+    """
+    Takes an exported model and a feature matrix with columns in the model's order and
+    returns the raw log-odds score for each row. Every tree is walked at once, one level
+    per step, and leaves point back to themselves so finished trees just stay put
+    """
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    n_rows, n_features = features.shape
+    flat_features = features.ravel()
+    feature_index = compiled_model['feature_index']
+    threshold = compiled_model['threshold']
+    default_left = compiled_model['default_left']
+    #node n's right child is at 2n and its left child at 2n + 1, so the split result picks the child
+    children = compiled_model['children']
+
+    row_offsets = (np.arange(n_rows, dtype=np.int32) * n_features)[:, None]
+    nodes = np.repeat(compiled_model['tree_roots'][None, :], n_rows, axis=0)
+    for _ in range(int(compiled_model['max_depth'])):
+        values = flat_features.take(row_offsets + feature_index.take(nodes))
+        go_left = values < threshold.take(nodes)
+        missing = np.isnan(values)
+        if missing.any():
+            go_left |= missing & default_left.take(nodes)
+        nodes = children.take(nodes * 2 + go_left)
+
+    return compiled_model['leaf_value'].take(nodes).sum(axis=1, dtype=np.float32) + compiled_model['base_margin']
+
+def predict_proba(compiled_model, features):
+    """
+    Takes an exported model and a feature matrix and returns class probabilities
+    in the same layout as XGBClassifier.predict_proba
+    """
+    high_scorer = 1 / (1 + np.exp(-predict_margin(compiled_model, features)))
+    return np.column_stack([1 - high_scorer, high_scorer])
@@ -1,4 +1,4 @@
-import hashlib, pickle, os, csv
+import hashlib, pickle, os, csv, json, time, glob, tempfile
 import numpy as np
 import pandas as pd
 
@@ -15,12 +15,48 @@ from imblearn.under_sampling import RandomUnderSampler
 import xgboost as xgb
 from xgboost import XGBClassifier, plot_importance
 
-def prep_test_or_train_data(data_csv):
+from compiled_model import COMPILED_MODEL_PATH, load_compiled_model, predict_proba
+
+FEATURE_COLUMNS = ['position_id',
+                   'player_value',
+                   'home_or_away_id',
+                   'opposition_team_strength',
+                   'team_strength',
+                   'recent_points',
+                   'recent_bps',
+                   'season_points',
+                   'season_bps',
+                   'season_minutes',
+                   'win_odds',
+                   'over_two_point_five_goals'
+                   ]
+
+def encode_features(features, encoder):
+    """
+    Takes the selected features and a fitted encoder, swaps home_or_away_id and
+    position_id for their one-hot encoded columns and returns the result
+    """
+    encoded_features = encoder.transform(features[['home_or_away_id', 'position_id']])
+
+    # Convert features to DataFrame before merging 
+    encoded_df = pd.DataFrame(encoded_features.toarray(), columns=encoder.get_feature_names_out()) # Convert sparse array to DataFrame
+
+    features = features.reset_index(drop=True)
+    encoded_df = encoded_df.reset_index(drop=True)
+
+    features = pd.concat([features, encoded_df], axis=1)
+
+    features = features.drop(columns=['position_id', 'home_or_away_id']) 
+
+    return features
+
+def prep_test_or_train_data(data_csv, matrix_folder=None):
     """
     Take a csv of data, makes it into a pandas dataframe,
     adjusts the content to make it appropriate for training a model
     and returns the features, target variable and column names from the
-    original data
+    original data. If a matrix folder is given the features and target are
+    also saved there so other processes can open them with load_data_matrix
     """
     data_components = {}
     data = pd.read_csv(data_csv)
@@ -34,19 +70,7 @@ def prep_test_or_train_data(data_csv):
     print('Loading data and dropping rows with no win_odds and fewer than 60 mins played')
 
     # Select relevant features
-    features = cleaned_data[['position_id',
-                            'player_value',
-                            'home_or_away_id',
-                            'opposition_team_strength',
-                            'team_strength',
-                            'recent_points',
-                            'recent_bps',
-                            'season_points',
-                            'season_bps',
-                            'season_minutes',
-                            'win_odds',
-                            'over_two_point_five_goals'
-                            ]]
+    features = cleaned_data[FEATURE_COLUMNS]
     
     #target variable                        
     target = cleaned_data['over_four_points']
@@ -54,21 +78,13 @@ def prep_test_or_train_data(data_csv):
     # Encode categorical features
     print('Encoding home or away and position id')
     encoder = OneHotEncoder(handle_unknown='ignore') 
-    encoded_features = encoder.fit_transform(features[['home_or_away_id', 'position_id']])
+    encoder.fit(features[['home_or_away_id', 'position_id']])
 
     # Save the encoder
     with open('saved_encoder.pkl', 'wb') as f:  # Choose a suitable filename
         pickle.dump(encoder, f)
     
-    # Convert features to DataFrame before merging 
-    encoded_df = pd.DataFrame(encoded_features.toarray(), columns=encoder.get_feature_names_out()) # Convert sparse array to DataFrame
-
-    features = features.reset_index(drop=True)
-    encoded_df = encoded_df.reset_index(drop=True)
-
-    features = pd.concat([features, encoded_df], axis=1)
-
-    features = features.drop(columns=['position_id', 'home_or_away_id']) 
+    features = encode_features(features, encoder)
 
 
     column_names = features.columns 
@@ -80,6 +96,54 @@ def prep_test_or_train_data(data_csv):
     data_components['column_names'] = column_names
     data_components['target'] = target
 
+    if matrix_folder is not None:
+        save_data_matrix(data_components, matrix_folder)
+
+    return data_components
+
+def save_data_matrix(data_components, matrix_folder):
+    """
+    Takes prepped features, target and column names and saves the features and
+    target as float32 .npy files along with a json list of the column names,
+    so worker processes can memory-map them instead of re-reading the csv
+    """
+    if not os.path.exists(matrix_folder):
+        os.makedirs(matrix_folder)
+
+    features = np.ascontiguousarray(data_components['features'][data_components['column_names']], dtype=np.float32)
+    target = np.ascontiguousarray(data_components['target'], dtype=np.float32)
+
+    np.save(os.path.join(matrix_folder, 'features.npy'), features)
+    np.save(os.path.join(matrix_folder, 'target.npy'), target)
+    with open(os.path.join(matrix_folder, 'column_names.json'), 'w') as f:
+        json.dump(list(data_components['column_names']), f)
+
+    print(f'data matrix saved to {matrix_folder}')
+    return None
+
+def is_data_matrix_current(data_csv, matrix_folder):
+    """
+    Takes a csv of data and a folder written by save_data_matrix and returns
+    True if every file of the matrix is there and newer than the csv, so the
+    prepping can be skipped and the saved matrix opened instead
+    """
+    matrix_files = [os.path.join(matrix_folder, name) for name in ('features.npy', 'target.npy', 'column_names.json')]
+    if not all(os.path.exists(matrix_file) for matrix_file in matrix_files):
+        return False
+    return min(os.path.getmtime(matrix_file) for matrix_file in matrix_files) >= os.path.getmtime(data_csv)
+
+def load_data_matrix(matrix_folder):
+    """
+    Takes a folder written by save_data_matrix and returns the features, target
+    and column names. The arrays are read-only memory maps so every process that
+    opens them shares the same pages instead of holding its own copy
+    """
+    data_components = {}
+    data_components['features'] = np.load(os.path.join(matrix_folder, 'features.npy'), mmap_mode='r')
+    data_components['target'] = np.load(os.path.join(matrix_folder, 'target.npy'), mmap_mode='r')
+    with open(os.path.join(matrix_folder, 'column_names.json')) as f:
+        data_components['column_names'] = json.load(f)
+
     return data_components
 
 def train_XGBoost_classifier_model(training_data_csv):
@@ -126,10 +190,117 @@ def train_XGBoost_classifier_model(training_data_csv):
 
     return {'model': model, 'original_column_names': training_data['column_names']}
 
-def tune_XGBoost_model(training_data):
+class ProcessedDataIter(xgb.DataIter):
+    """
+    Feeds processed data files to XGBoost a chunk at a time, so only one chunk
+    is held as a dataframe however many files there are
+    """
+
+    def __init__(self, data_files, encoder, chunksize, cache_prefix=None):
+        self.data_files = data_files
+        self.encoder = encoder
+        self.chunksize = chunksize
+        self.chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def read_chunks(self):
+        for data_file in self.data_files:
+            for chunk in pd.read_csv(data_file, chunksize=self.chunksize):
+                #same cleaning as prep_test_or_train_data
+                chunk = chunk.dropna(subset=['win_odds'])
+                if not chunk.empty:
+                    yield chunk
+
+    def next(self, input_data):
+        if self.chunks is None:
+            self.chunks = self.read_chunks()
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return 0
+        features = encode_features(chunk[FEATURE_COLUMNS], self.encoder)
+        input_data(data=features, label=chunk['over_four_points'].to_numpy())
+        return 1
+
+    def reset(self):
+        self.chunks = None
+
+def scan_training_data(data_files, chunksize):
+    """
+    Takes processed data files and reads just the columns needed to fit the encoder
+    and count the classes, a chunk at a time. Returns the fitted encoder and the
+    ratio of low to high scorers used to weight the high scorers in training
+    """
+    categories = []
+    class_counts = pd.Series(0, index=[0, 1])
+    for data_file in data_files:
+        for chunk in pd.read_csv(data_file, usecols=['win_odds', 'home_or_away_id', 'position_id', 'over_four_points'], chunksize=chunksize):
+            chunk = chunk.dropna(subset=['win_odds'])
+            categories.append(chunk[['home_or_away_id', 'position_id']].drop_duplicates())
+            class_counts = class_counts.add(chunk['over_four_points'].value_counts(), fill_value=0)
+
+    if class_counts[1] == 0:
+        raise ValueError('No high scorers found in the training data')
+
+    encoder = OneHotEncoder(handle_unknown='ignore')
+    encoder.fit(pd.concat(categories).drop_duplicates())
+
+    return {'encoder': encoder, 'scale_pos_weight': class_counts[0] / class_counts[1]}
+
+def train_XGBoost_classifier_model_in_chunks(data_files_pattern, chunksize=50000, external_memory=False):
+    """
+    Takes a glob pattern of processed data files and trains an XGBoost model on them
+    without loading them all at once. Data is fed in chunks into a QuantileDMatrix, which
+    keeps the quantized data in memory, or with external_memory set into a matrix cached
+    on disk for data that won't fit in memory at all, and class imbalance is
+    handled by weighting the high scorers instead of resampling the whole dataset.
+    Returns the trained model and the column names, like train_XGBoost_classifier_model
+    """
+    data_files = sorted(glob.glob(data_files_pattern))
+    if not data_files:
+        raise ValueError(f'No processed data files match {data_files_pattern}')
+
+    print(f'Scanning {len(data_files)} data files')
+    scan = scan_training_data(data_files, chunksize)
+    encoder = scan['encoder']
+
+    # Save the encoder
+    with open('saved_encoder.pkl', 'wb') as f:
+        pickle.dump(encoder, f)
+
+    params = {'objective': 'binary:logistic', 'tree_method': 'hist', 'scale_pos_weight': scan['scale_pos_weight']}
+
+    print('Training Model')
+    with tempfile.TemporaryDirectory() as cache_folder:
+        if external_memory:
+            data_iter = ProcessedDataIter(data_files, encoder, chunksize, cache_prefix=os.path.join(cache_folder, 'cache'))
+            #newer XGBoost versions keep the quantized pages on disk too, older ones cache the raw pages
+            if hasattr(xgb, 'ExtMemQuantileDMatrix'):
+                training_data = xgb.ExtMemQuantileDMatrix(data_iter)
+            else:
+                training_data = xgb.DMatrix(data_iter)
+        else:
+            data_iter = ProcessedDataIter(data_files, encoder, chunksize)
+            training_data = xgb.QuantileDMatrix(data_iter)
+
+        column_names = pd.Index(training_data.feature_names)
+        booster = xgb.train(params, training_data, num_boost_round=100)
+        #free the matrix while its cache files still exist so XGBoost can clean them up
+        del training_data
+
+    #wrap the booster so it saves, loads and predicts like the in-memory model
+    model = XGBClassifier()
+    model.load_model(bytearray(booster.save_raw('json')))
+
+    return {'model': model, 'original_column_names': column_names}
+
+def tune_XGBoost_model(training_data, matrix_folder='./processed_data/tuning_matrix'):
     """
     Tries different hyperparamters of a model and prints
-    the best combination.
+    the best combination. The data is prepped into a memory-mapped
+    matrix that is reused until the csv changes, and the grid search
+    runs across all cores. Workers are handed the memory map rather
+    than a pickled copy of the data, but each still copies out the
+    rows of its own fold to fit on
     """
 
     param_grid = {
@@ -152,10 +323,13 @@ def tune_XGBoost_model(training_data):
 
 
 
-    xgb_model = XGBClassifier()  
-    grid_search = GridSearchCV(estimator=xgb_model, param_grid=param_grid, cv=5, scoring=my_custom_scorer, verbose=1)
+    #one thread per model so the parallelism comes from the grid search workers
+    xgb_model = XGBClassifier(n_jobs=1)  
+    grid_search = GridSearchCV(estimator=xgb_model, param_grid=param_grid, cv=5, scoring=my_custom_scorer, verbose=1, n_jobs=-1)
 
-    test_data = prep_test_or_train_data('./processed_data/testing_data.csv')
+    if not is_data_matrix_current(training_data, matrix_folder):
+        prep_test_or_train_data(training_data, matrix_folder)
+    test_data = load_data_matrix(matrix_folder)
 
     grid_search.fit(test_data['features'], test_data['target']) 
 
@@ -236,3 +410,147 @@ def train_and_save_XGBoost_classifier_model():
     trained_model = train_XGBoost_classifier_model('./processed_data/training_data.csv')
     save_model(trained_model['model'], trained_model['original_column_names'])
     return None
+
+def train_and_save_XGBoost_classifier_model_in_chunks(data_files_pattern, external_memory=False):
+    """
+    Trains an XGBoost model a chunk at a time on the processed data files matching
+    the given pattern, optionally through XGBoost's external memory, then saves it.
+    """
+    trained_model = train_XGBoost_classifier_model_in_chunks(data_files_pattern, external_memory=external_memory)
+    save_model(trained_model['model'], trained_model['original_column_names'])
+    return None
+
+def get_tree_depth(left_children, right_children):
+    """
+    Takes the child arrays of a single tree and returns its depth
+    """
+    max_depth = 0
+    stack = [(0, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if left_children[node] == -1:
+            max_depth = max(max_depth, depth)
+            continue
+        stack.append((left_children[node], depth + 1))
+        stack.append((right_children[node], depth + 1))
+    return max_depth
+
+def get_encoded_column(column_name):
+    """
+    Takes one of a model's column names and returns the categorical column and category
+    it one-hot encodes, or ('', nan) for a column that is used as it is. Raises a
+    ValueError for a column that is neither
+    """
+    #one-hot columns are named <column>_<category> by the encoder
+    for encoded_column in ['home_or_away_id', 'position_id']:
+        prefix = f'{encoded_column}_'
+        if column_name.startswith(prefix):
+            try:
+                return encoded_column, float(column_name[len(prefix):])
+            except ValueError:
+                break
+    if column_name in FEATURE_COLUMNS:
+        return '', np.nan
+    raise ValueError(f"Can't work out how to build the model's column {column_name} from gameweek data")
+
+def export_compiled_model(model_filepath, compiled_filepath=COMPILED_MODEL_PATH):
+    """
+    Takes a saved model and converts its trees into flat node arrays (feature, threshold,
+    children and leaf values) saved with NumPy, along with the column names and the
+    one-hot categories behind them, so compiled_model.py can make the same predictions
+    with only NumPy
+    """
+    model = load_and_verify_model(model_filepath)
+    with open(model_filepath, 'rb') as f:
+        column_names = list(pickle.load(f)['column_names'])
+
+    learner = json.loads(model.get_booster().save_raw('json'))['learner']
+    if learner['objective']['name'] != 'binary:logistic' or learner['gradient_booster']['name'] != 'gbtree':
+        raise ValueError('Only gbtree models with a binary:logistic objective can be exported')
+
+    trees = learner['gradient_booster']['model']['trees']
+    #sklearn's predict_proba stops at the best iteration when early stopping was used
+    try:
+        trees = trees[:model.best_iteration + 1]
+    except AttributeError:
+        pass
+
+    feature_index, threshold, children, default_left, leaf_value, tree_roots = [], [], [], [], [], []
+    max_depth = 0
+    offset = 0
+    for tree in trees:
+        left = np.array(tree['left_children'], dtype=np.int32)
+        right = np.array(tree['right_children'], dtype=np.int32)
+        is_leaf = left == -1
+        node_ids = np.arange(len(left), dtype=np.int32) + offset
+
+        #leaves point to themselves so evaluation can run every tree for the same number of steps,
+        #and each node's children are stored as a (right, left) pair so a split result indexes them
+        left_child = np.where(is_leaf, node_ids, left + offset)
+        right_child = np.where(is_leaf, node_ids, right + offset)
+        children.append(np.stack([right_child, left_child], axis=1).ravel())
+        feature_index.append(np.where(is_leaf, 0, tree['split_indices']))
+        threshold.append(np.array(tree['split_conditions'], dtype=np.float32))
+        default_left.append(np.array(tree['default_left'], dtype=bool))
+        #for leaves split_conditions holds the leaf value
+        leaf_value.append(np.where(is_leaf, np.array(tree['split_conditions'], dtype=np.float32), 0))
+        tree_roots.append(offset)
+
+        max_depth = max(max_depth, get_tree_depth(left, right))
+        offset += len(left)
+
+    base_score = float(learner['learner_model_param']['base_score'])
+
+    #the categories come from the model's own column names, not whichever encoder was saved last
+    encoded_columns, encoded_categories = zip(*[get_encoded_column(name) for name in column_names])
+
+    folder_path = os.path.dirname(compiled_filepath)
+    if folder_path and not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+
+    np.savez(compiled_filepath,
+             feature_index=np.concatenate(feature_index).astype(np.int32),
+             threshold=np.concatenate(threshold),
+             children=np.concatenate(children).astype(np.int32),
+             default_left=np.concatenate(default_left),
+             leaf_value=np.concatenate(leaf_value).astype(np.float32),
+             tree_roots=np.array(tree_roots, dtype=np.int32),
+             max_depth=np.array(max_depth),
+             base_margin=np.float32(np.log(base_score / (1 - base_score))),
+             column_names=np.array(column_names),
+             encoded_columns=np.array(encoded_columns, dtype=str),
+             encoded_categories=np.array(encoded_categories, dtype=np.float64))
+
+    print(f'{len(trees)} trees with {offset} nodes exported to {compiled_filepath}')
+    return None
+
+def benchmark_compiled_model(model_filepath, compiled_filepath, testing_data_csv):
+    """
+    Takes a saved model, its exported version and some test data, then prints
+    how long each takes to load and predict and how far apart their predictions are
+    """
+    start = time.perf_counter()
+    with open(model_filepath, 'rb') as f:
+        model = pickle.load(f)['model']
+    native_load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled_model = load_compiled_model(compiled_filepath)
+    compiled_load_time = time.perf_counter() - start
+
+    test_data = prep_test_or_train_data(testing_data_csv)
+    features = test_data['features'][list(compiled_model['column_names'])]
+
+    start = time.perf_counter()
+    native_predictions = model.predict_proba(features)
+    native_predict_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled_predictions = predict_proba(compiled_model, features.to_numpy())
+    compiled_predict_time = time.perf_counter() - start
+
+    print(f'native:   load {native_load_time * 1000:.1f}ms, predict {len(features)} rows {native_predict_time * 1000:.1f}ms')
+    print(f'compiled: load {compiled_load_time * 1000:.1f}ms, predict {len(features)} rows {compiled_predict_time * 1000:.1f}ms')
+    print('max difference in predictions:', np.abs(native_predictions - compiled_predictions).max())
+
+    return None
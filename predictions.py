@@ -1,14 +1,16 @@
 import os
 import csv
 import pickle
+import numpy as np
 import pandas as pd
 
 
-from processors import create_gameweeks_dataframe, create_future_gameweeks_df
+from compiled_model import COMPILED_MODEL_PATH, load_compiled_model, prep_rows_for_compiled_model, predict_proba
+from handlers import get_fpl_fixtures_data
+from processors import create_gameweeks_dataframe, create_future_gameweeks_df, is_gameweek_finished
+from simulation import simulate_gameweek_points
 
 
-NEXT_GAMEWEEK = 30 #used to determine whether dealing with historic data or constructing future data
-
 def prep_data_for_prediction(gameweek_data):
     """
     Takes gameweek data, encodes columns and drops columns
@@ -38,11 +40,60 @@ def prep_data_for_prediction(gameweek_data):
         return data_for_prediction
 
 
-def make_gameweek_predictions(model_filepath, gameweek_data):
+def add_feature_contributions(model, data_for_prediction, gameweek_data, interactions=False):
+    """
+    Takes a trained model, the data it is predicting on and the gameweek data the
+    predictions are written to. Computes every row's feature contributions in a single
+    booster call and adds a column per feature (in log-odds, so a row's contributions
+    plus its bias add up to the model's raw score). If interactions is set, also adds
+    a column per pair of features with the SHAP interaction value for that pair
+    """
+    #imported here so predicting with the compiled model never needs xgboost installed
+    import xgboost as xgb
+
+    column_names = list(data_for_prediction.columns)
+    dmatrix = xgb.DMatrix(data_for_prediction, feature_names=column_names)
+    booster = model.get_booster()
+
+    contributions = booster.predict(dmatrix, pred_contribs=True)
+    contributions_df = pd.DataFrame(contributions, columns=[f'contribution_{c}' for c in column_names] + ['contribution_bias'])
+
+    if interactions:
+        #interaction matrices are symmetric so each pair is the upper triangle value counted twice
+        interaction_values = booster.predict(dmatrix, pred_interactions=True)
+        rows, cols = np.triu_indices(len(column_names), k=1)
+        pair_values = interaction_values[:, rows, cols] * 2
+        pair_names = [f'interaction_{column_names[i]}_x_{column_names[j]}' for i, j in zip(rows, cols)]
+        interactions_df = pd.DataFrame(pair_values, columns=pair_names)
+        contributions_df = pd.concat([contributions_df, interactions_df], axis=1)
+
+    return pd.concat([gameweek_data, contributions_df], axis=1)
+
+def make_compiled_gameweek_predictions(compiled_filepath, gameweek_data):
+    """
+    Takes preprocessed gameweek data and the filepath of a model exported with
+    export_compiled_model and returns the gameweek data with its predictions.
+    Only needs NumPy and pandas, not xgboost, sklearn or the pickled encoder
+    """
+    print('loading compiled model')
+    compiled_model = load_compiled_model(compiled_filepath)
+    gameweek_data.reset_index(drop=True, inplace=True)
+    features = prep_rows_for_compiled_model(compiled_model, gameweek_data)
+    gameweek_data['predicted_high_scorer'] = predict_proba(compiled_model, features)[:, 1]
+    return gameweek_data
+
+def make_gameweek_predictions(model_filepath, gameweek_data, explain=False, interactions=False):
     """
     Takes preprocessed and prepped gameweek data and the filepath of a saved model and uses the saved model
-    to make predictions and returns a dataframe with the given predictions
+    to make predictions and returns a dataframe with the given predictions. If explain is set the
+    per-feature contributions behind each prediction are added as well. A compiled model (.npz)
+    is evaluated with NumPy alone, and can't explain its predictions
     """
+    if model_filepath.endswith('.npz'):
+        if explain:
+            raise ValueError('Explaining predictions needs the XGBoost model, not the compiled one')
+        return make_compiled_gameweek_predictions(model_filepath, gameweek_data)
+
 
     data_for_prediction = prep_data_for_prediction(gameweek_data)
     
@@ -59,20 +110,30 @@ def make_gameweek_predictions(model_filepath, gameweek_data):
         # Add probabilities of being a high-scorer
         gameweek_data['predicted_high_scorer'] = predictions_proba[:, 1]  # Assuming the 2nd column is for high-scorer
 
+        if explain:
+            print('explaining predictions')
+            gameweek_data = add_feature_contributions(model, data_for_prediction, gameweek_data, interactions)
+
         return gameweek_data
 
-def predict_gameweek(gameweek):
+def predict_gameweek(gameweek, explain=False, interactions=False, simulate=False, compiled=False):
     """
     Takes a gameweek, fetches data for it and uses a pre-trained model to
     makes predictions on the outcomes of it. Outputs a CSV which shows the 
-    predictions and the actual points scored
+    predictions and the actual points scored, followed by the feature
+    contributions behind each prediction if explain is set (and the pairwise
+    feature interactions if interactions is set too). If simulate is
+    set also outputs a CSV of each player's simulated points distribution. If
+    compiled is set the exported NumPy model is used instead of the XGBoost one
     """
     print('fetching gameweek data')
-    if gameweek < NEXT_GAMEWEEK:
+    #played gameweeks use what actually happened, anything else is built from the fixtures
+    if is_gameweek_finished(get_fpl_fixtures_data(), gameweek):
         gameweek_data = create_gameweeks_dataframe(gameweek, gameweek)
     else:
         gameweek_data = create_future_gameweeks_df(gameweek)
-    gameweek_predictions = make_gameweek_predictions('./trained_models/trained_XGBoost_model.pkl', gameweek_data)
+    model_filepath = COMPILED_MODEL_PATH if compiled else './trained_models/trained_XGBoost_model.pkl'
+    gameweek_predictions = make_gameweek_predictions(model_filepath, gameweek_data, explain, interactions)
     filename = f'predictionsGW{gameweek}.csv'
 
     folder_path = 'predictions'
@@ -84,10 +145,19 @@ def predict_gameweek(gameweek):
 
     with open(filepath, 'w', newline='') as csvfile: 
         writer = csv.writer(csvfile)
-        output_data = gameweek_predictions[['player_name', 'opposition_name', 'points', 'predicted_high_scorer']]
+        output_columns = ['player_name', 'opposition_name', 'points', 'predicted_high_scorer']
+        output_columns += [c for c in gameweek_predictions.columns if c.startswith(('contribution_', 'interaction_'))]
+        output_data = gameweek_predictions[output_columns]
         output_data = output_data.sort_values(by='predicted_high_scorer', ascending=False)
         print(f'saving predictions for gameweek {gameweek} to {filepath}')
 
         output_data.to_csv(csvfile, mode='a', index=False)
+
+    if simulate:
+        print(f'simulating gameweek {gameweek}')
+        simulation = simulate_gameweek_points(gameweek_predictions)
+        filepath = os.path.join(folder_path, f'simulationGW{gameweek}.csv')
+        print(f'saving simulation for gameweek {gameweek} to {filepath}')
+        simulation['summary'].to_csv(filepath, index=False)
     
     return None
@@ -1,12 +1,62 @@
 import pandas as pd
-import os, csv
+import os, json, tempfile
 from random import randint
 from datetime import datetime
 from handlers import get_fpl_bootstrap_data, get_fpl_fixtures_data, get_fpl_gameweek_live_data 
 
-def get_data_for_gameweeks():
+LIVE_DATA_FOLDER = './raw_data/live' #cached gameweek live data so unchanged gameweeks aren't fetched again
+
+def is_gameweek_finished(fixtures_data, gameweek):
+    """
+    Takes the fixtures data and a gameweek and returns whether
+    every fixture in that gameweek has finished
+    """
+    gameweek_fixtures = [fixture for fixture in fixtures_data if fixture['event'] == gameweek]
+    return len(gameweek_fixtures) > 0 and all(fixture['finished'] for fixture in gameweek_fixtures)
+
+def get_fixtures_state(fixtures_data, gameweek):
+    """
+    Takes the fixtures data and a gameweek and returns how many of its fixtures have
+    provisionally finished and how many are confirmed finished. The live data for a
+    gameweek only changes in ways that matter to us when one of these does
+    """
+    gameweek_fixtures = [fixture for fixture in fixtures_data if fixture['event'] == gameweek]
+    provisionally_finished = sum(1 for fixture in gameweek_fixtures if fixture.get('finished_provisional'))
+    finished = sum(1 for fixture in gameweek_fixtures if fixture['finished'])
+    return [provisionally_finished, finished]
+
+def get_gameweek_live_data(gameweek, fixtures_data, refresh=False):
+    """
+    Takes a gameweek and the fixtures data and returns the gameweek's live data, from the
+    cache if it was saved when the gameweek's fixtures were in the same state as they are
+    now, otherwise from the FPL API. Setting refresh always fetches it
     """
-    Gets all of the data needed for given gameweeks and returns it in a single dictionary
+    fixtures_state = get_fixtures_state(fixtures_data, gameweek)
+    filepath = os.path.join(LIVE_DATA_FOLDER, f'gameweek_{gameweek}.json')
+
+    if not refresh and os.path.exists(filepath):
+        with open(filepath) as f:
+            cached_data = json.load(f)
+        if cached_data['fixtures_state'] == fixtures_state:
+            return cached_data['performances']
+
+    print(f'gameweek {gameweek}')
+    gameweek_data = get_fpl_gameweek_live_data(gameweek)
+
+    if not os.path.exists(LIVE_DATA_FOLDER):
+        os.makedirs(LIVE_DATA_FOLDER, exist_ok=True)
+    #write to a temporary file first so anything reading the cache never sees half a file
+    with tempfile.NamedTemporaryFile('w', dir=LIVE_DATA_FOLDER, suffix='.tmp', delete=False) as f:
+        json.dump({'fixtures_state': fixtures_state, 'performances': gameweek_data}, f)
+    os.replace(f.name, filepath)
+
+    return gameweek_data
+
+def get_data_for_gameweeks(last_gameweek, refresh_gameweeks=()):
+    """
+    Gets all of the data needed for given gameweeks and returns it in a single dictionary.
+    Live data is needed for every gameweek up to and including last_gameweek, but only
+    gameweeks that have changed since they were cached, or are in refresh_gameweeks, are fetched
     """
     all_data = {'gameweeks': []}
     bootstrap_data = get_fpl_bootstrap_data()
@@ -14,10 +64,9 @@ def get_data_for_gameweeks():
     all_data['bootstrap_data'] = bootstrap_data
     all_data['fixtures_data'] = fixtures_data
     print("getting all gameweeks data")
-    for i in range(1, 29):
-        print(f'gameweek {i}')
+    for i in range(1, last_gameweek+1):
         gameweeks_dict = {}
-        gameweek_data = get_fpl_gameweek_live_data(i)
+        gameweek_data = get_gameweek_live_data(i, fixtures_data, i in refresh_gameweeks)
         gameweeks_dict['gameweek'] = i
         gameweeks_dict['performances'] = gameweek_data
         all_data['gameweeks'].append(gameweeks_dict)
@@ -301,7 +350,9 @@ def clean_and_interpret_data(gameweeks_and_static_dict, start_gameweek, end_game
 
 def save_data_csv(gameweeks_df, filename):
     """
-    Takes gameweeks dataframe and saves it with the given filename
+    Takes gameweeks dataframe and saves it with the given filename. It is written
+    to a temporary file and moved into place so anything reading the processed data
+    folder, like a chunked training run, never sees a half-written csv
     """
     folder_path = 'processed_data'
     if not os.path.exists(folder_path):
@@ -309,10 +360,10 @@ def save_data_csv(gameweeks_df, filename):
 
     filepath = os.path.join(folder_path, filename) 
 
-    with open(filepath, 'w', newline='') as csvfile: 
-        writer = csv.writer(csvfile)
+    with tempfile.NamedTemporaryFile('w', dir=folder_path, suffix='.tmp', newline='', delete=False) as csvfile:
         print(f'saving data for  to {filepath}')
-        gameweeks_df.to_csv(csvfile, mode='a', index=False)
+        gameweeks_df.to_csv(csvfile, index=False)
+    os.replace(csvfile.name, filepath)
     
     return None
 
@@ -321,18 +372,19 @@ def create_gameweeks_dataframe(start_gameweek, end_gameweek):
     Takes the dictionary of clean interpreted data and turns it into a dataframe.
     used in run.py to pull the data in before making predictions
     """
-    all_gameweeks = get_data_for_gameweeks()
+    all_gameweeks = get_data_for_gameweeks(end_gameweek)
     clean_and_interpreted_data_dict = clean_and_interpret_data(all_gameweeks, start_gameweek, end_gameweek)
     performances = clean_and_interpreted_data_dict['performances']
     df = pd.DataFrame(performances)
     return df
 
-def create_data_for_gameweeks(start_gameweek, end_gameweek, filename):
+def create_data_for_gameweeks(start_gameweek, end_gameweek, filename, refresh_gameweeks=()):
     """
     Gets the data for the chosen gameweeks, cleans it, interprets it
-    puts it into a single dataframe and saves it with the given filename
+    puts it into a single dataframe and saves it with the given filename.
+    Gameweeks in refresh_gameweeks are fetched again even if they are cached
     """
-    all_gameweeks = get_data_for_gameweeks()
+    all_gameweeks = get_data_for_gameweeks(end_gameweek, refresh_gameweeks)
     clean_and_interpreted_data_dict = clean_and_interpret_data(all_gameweeks, start_gameweek, end_gameweek)
     performances = clean_and_interpreted_data_dict['performances']
     gameweeks_df = pd.DataFrame(performances)
@@ -350,8 +402,12 @@ def get_fixture_id(fixtures, player_team_id, gameweek):
     return gameweek_fixture['id']
     
 def create_future_gameweeks_df(gameweek):
+    """
+    Takes a gameweek that hasn't been played and builds a dataframe of the players
+    expected to feature in it, with their form from the gameweeks before it
+    """
     resp = {'performances': []}
-    all_gameweeks_data = get_data_for_gameweeks()
+    all_gameweeks_data = get_data_for_gameweeks(gameweek - 1)
     fixtures = all_gameweeks_data['fixtures_data']
     bootstrap = all_gameweeks_data['bootstrap_data']
     all_gameweeks = all_gameweeks_data['gameweeks']
@@ -1,16 +1,22 @@
 from predictions import predict_gameweek
-from models import train_and_save_XGBoost_classifier_model, save_model, tune_XGBoost_model, test_model
+from models import train_and_save_XGBoost_classifier_model, train_and_save_XGBoost_classifier_model_in_chunks, save_model, tune_XGBoost_model, test_model, export_compiled_model, benchmark_compiled_model
 from processors import create_data_for_gameweeks
+from scheduler import RefreshScheduler
 
 from random import randint
 
+scheduler = None
 
 while True:
-    a = input("Choose an option \n 1. predict gameweek \n 2. train_model \n 3. test_model \n 4. tune model \n 5. create data \n\n")
+    a = input("Choose an option \n 1. predict gameweek \n 2. train_model \n 3. test_model \n 4. tune model \n 5. create data \n 6. start refresh scheduler \n 7. export compiled model \n 8. train model in chunks \n\n")
 
     if a == "1":
         a2 = input("which gameweek?")
-        predict_gameweek(int(a2))  
+        a3 = input("use compiled model? (y/n)")
+        a4 = input("explain predictions? (y/n)") if a3.lower() != 'y' else 'n'
+        a5 = input("include feature interactions? (y/n)") if a4.lower() == 'y' else 'n'
+        a6 = input("simulate points? (y/n)")
+        predict_gameweek(int(a2), explain=a4.lower() == 'y', interactions=a5.lower() == 'y', simulate=a6.lower() == 'y', compiled=a3.lower() == 'y')  
     elif a == "2":
         train_and_save_XGBoost_classifier_model()
     elif a == "3":
@@ -22,6 +28,19 @@ while True:
         a3 = input("Enter end gameweek: ")
         a4 = input("Enter filename: ")
         create_data_for_gameweeks(int(a2), int(a3), a4)
+    elif a == "6":
+        if scheduler is None:
+            scheduler = RefreshScheduler()
+            scheduler.start()
+        else:
+            print("Refresh scheduler is already running")
+    elif a == "7":
+        export_compiled_model('./trained_models/trained_XGBoost_model.pkl')
+        benchmark_compiled_model('./trained_models/trained_XGBoost_model.pkl', './trained_models/compiled_XGBoost_model.npz', './processed_data/testing_data.csv')
+    elif a == "8":
+        a2 = input("Enter data files pattern (e.g. ./processed_data/gameweek_*.csv): ")
+        a3 = input("use external memory? (y/n)")
+        train_and_save_XGBoost_classifier_model_in_chunks(a2, a3.lower() == 'y')
     else:
         print("Invalid input. Please try again.") 
         continue  # Skip back to the beginning of the loop
@@ -31,3 +50,9 @@ while True:
     if exit_choice.lower() != 'y':
         break
 
+if scheduler is not None:
+    print("Refresh scheduler still running, press Ctrl+C to stop it")
+    try:
+        scheduler.wait()
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -0,0 +1,212 @@
+import heapq, threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from handlers import get_fpl_fixtures_data
+from processors import create_data_for_gameweeks
+from predictions import predict_gameweek
+
+
+MATCH_LENGTH = timedelta(hours=2) #kickoff to full time including half time and stoppages
+DEADLINE_LEAD_TIME = timedelta(hours=3) #FPL deadlines are 90 minutes before the first kickoff
+REPLAN_INTERVAL = timedelta(hours=6) #fixtures get moved so the plan is rebuilt from fresh fixtures data
+RETRY_DELAY = timedelta(minutes=5) #how long a job waits if the same job is already running
+MAX_WORKERS = 2 #jobs hammer the FPL API so only a couple run at once
+
+
+def parse_kickoff_time(kickoff_time):
+    """
+    Takes a kickoff time string from the fixtures data and
+    returns it as a timezone aware datetime
+    """
+    return datetime.strptime(kickoff_time, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+def get_gameweek_kickoffs(fixtures):
+    """
+    Takes the fixtures data and returns a dictionary of gameweek number to a
+    sorted list of the kickoff times in that gameweek. Fixtures without a gameweek
+    or a kickoff time (postponed and unscheduled games) are left out
+    """
+    gameweek_kickoffs = {}
+    for fixture in fixtures:
+        if fixture.get('event') is None or fixture.get('kickoff_time') is None:
+            continue
+        gameweek_kickoffs.setdefault(fixture['event'], []).append(parse_kickoff_time(fixture['kickoff_time']))
+    for kickoffs in gameweek_kickoffs.values():
+        kickoffs.sort()
+    return gameweek_kickoffs
+
+def plan_refresh_jobs(fixtures, now):
+    """
+    Takes the fixtures data and the current time and returns a list of the jobs still to
+    run, soonest first. Each job is a tuple of (run_at, job_type, gameweek):
+    - 'rebuild' after every match finishes, rebuilding that gameweek's data
+    - 'predict' ahead of every gameweek deadline, to pick up late team news and odds
+    The following gameweek's predict once a gameweek is over isn't planned here, the
+    scheduler queues it when that gameweek's last rebuild finishes
+    """
+    jobs = []
+    gameweek_kickoffs = get_gameweek_kickoffs(fixtures)
+
+    for gameweek, kickoffs in gameweek_kickoffs.items():
+        for kickoff in kickoffs:
+            finish = kickoff + MATCH_LENGTH
+            if finish > now:
+                jobs.append((finish, 'rebuild', gameweek))
+
+        deadline = kickoffs[0]
+        if deadline > now:
+            #if we are already inside the lead time, run straight away rather than skip it
+            jobs.append((max(deadline - DEADLINE_LEAD_TIME, now), 'predict', gameweek))
+
+    jobs.sort()
+    return jobs
+
+def rebuild_gameweek_data(gameweek):
+    """
+    Takes a gameweek and rebuilds the processed data for just that gameweek, saving it to
+    its own file. Only this gameweek's live data is fetched, the rest comes from the cache,
+    and the refreshed cache is what the following predict jobs build their features from
+    """
+    create_data_for_gameweeks(gameweek, gameweek, f'gameweek_{gameweek}.csv', refresh_gameweeks=[gameweek])
+    return None
+
+
+JOB_FUNCTIONS = {
+    'rebuild': rebuild_gameweek_data,
+    'predict': predict_gameweek,
+}
+
+
+class RefreshScheduler:
+    """
+    Runs the planned refresh jobs in a background thread, at most max_workers at a time.
+    Identical jobs that fall due together are run once, and a job that is already running
+    is pushed back rather than run twice at the same time. The next gameweek's predict is
+    chained onto the last rebuild of a gameweek so it never races the rebuild
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, poll_seconds=60):
+        self.poll_seconds = poll_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.queue = []
+        self.running = set()
+        self.retried = set()
+        self.gameweeks = set()
+        self.next_replan = None
+        self.thread = None
+
+    def start(self):
+        """
+        Plans the jobs from the current fixtures and starts working through them
+        """
+        self.replan(datetime.now(timezone.utc))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return None
+
+    def stop(self):
+        """
+        Stops picking up new jobs and waits for any running ones to finish
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+        return None
+
+    def wait(self):
+        """
+        Blocks until the scheduler is stopped
+        """
+        while self.thread is not None and self.thread.is_alive():
+            self.thread.join(self.poll_seconds)
+        return None
+
+    def replan(self, now):
+        """
+        Fetches the fixtures and replaces the queue with a fresh plan. Jobs that are already
+        due or were pushed back are kept, since the fresh plan only has jobs still to come
+        """
+        print('planning data refresh jobs')
+        fixtures = get_fpl_fixtures_data()
+        jobs = plan_refresh_jobs(fixtures, now)
+        with self.lock:
+            self.gameweeks = set(get_gameweek_kickoffs(fixtures))
+            kept_jobs = [job for job in self.queue if job[0] <= now or job in self.retried]
+            self.queue = sorted(set(jobs + kept_jobs))
+            self.retried.intersection_update(self.queue)
+            jobs = self.queue
+        self.next_replan = now + REPLAN_INTERVAL
+        if jobs:
+            print(f'{len(jobs)} jobs planned, next is {jobs[0][1]} gameweek {jobs[0][2]} at {jobs[0][0]}')
+        return None
+
+    def run(self):
+        """
+        Main loop, submits every job that is due then sleeps until the next poll
+        """
+        while not self.stop_event.is_set():
+            now = datetime.now(timezone.utc)
+            if now >= self.next_replan:
+                try:
+                    self.replan(now)
+                except Exception as e:
+                    print(f'failed to plan refresh jobs: {e}')
+                    self.next_replan = now + RETRY_DELAY
+            self.submit_due_jobs(now)
+            self.stop_event.wait(self.poll_seconds)
+        return None
+
+    def submit_due_jobs(self, now):
+        """
+        Pops every job that is due, collapses duplicates and hands them to the executor
+        """
+        with self.lock:
+            due_jobs = []
+            while self.queue and self.queue[0][0] <= now:
+                run_at, job_type, gameweek = heapq.heappop(self.queue)
+                self.retried.discard((run_at, job_type, gameweek))
+                job = (job_type, gameweek)
+                if job in due_jobs:
+                    continue
+                if job in self.running:
+                    retry = (now + RETRY_DELAY, job_type, gameweek)
+                    heapq.heappush(self.queue, retry)
+                    self.retried.add(retry)
+                    continue
+                due_jobs.append(job)
+            self.running.update(due_jobs)
+
+        for job in due_jobs:
+            print(f'running {job[0]} for gameweek {job[1]}')
+            future = self.executor.submit(JOB_FUNCTIONS[job[0]], job[1])
+            future.add_done_callback(lambda f, job=job: self.job_finished(job, f))
+        return None
+
+    def job_finished(self, job, future):
+        """
+        Clears a job from the running set and reports if it failed. When a rebuild succeeds
+        and no other rebuild of that gameweek is still queued, the gameweek is over and
+        rebuilt, so the following gameweek's predict is queued to run straight away
+        """
+        job_type, gameweek = job
+        failed = future.exception() is not None
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            self.running.discard(job)
+            gameweek_rebuilt = (
+                job_type == 'rebuild' and not failed and gameweek + 1 in self.gameweeks
+                and not any((queued_type, queued_gameweek) == job for _, queued_type, queued_gameweek in self.queue)
+            )
+            if gameweek_rebuilt:
+                heapq.heappush(self.queue, (now, 'predict', gameweek + 1))
+
+        if failed:
+            print(f'{job_type} for gameweek {gameweek} failed: {future.exception()}')
+        if gameweek_rebuilt and not self.stop_event.is_set():
+            print(f'gameweek {gameweek} rebuilt, predicting gameweek {gameweek + 1}')
+            self.submit_due_jobs(now)
+        return None
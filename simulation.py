@@ -0,0 +1,273 @@
+import numpy as np
+import pandas as pd
+
+
+N_SAMPLES = 20000
+DEFAULT_MATCH_GOALS = 2.8 #used when a fixture has no over 2.5 goals odds
+DEFAULT_WIN_PROBABILITY = 1 / 3 #used when a team has no win odds
+HAUL_POINTS = 10 #a double figure score, worth 20 or more as captain
+
+#FPL scoring by position id (1 goalkeeper, 2 defender, 3 midfielder, 4 forward)
+APPEARANCE_POINTS = 2
+ASSIST_POINTS = 3
+GOAL_POINTS = {1: 6, 2: 6, 3: 5, 4: 4}
+CLEAN_SHEET_POINTS = {1: 4, 2: 4, 3: 1, 4: 0}
+CONCEDED_PENALTY_POSITIONS = {1, 2} #lose a point for every 2 goals conceded
+
+#share of a player's goal involvements that are goals rather than assists
+GOAL_FRACTION = {1: 0.0, 2: 0.35, 3: 0.45, 4: 0.65}
+MAX_SCORER_SHARE = 0.95 #leave some goals for own goals and players outside the pool
+MAX_ASSIST_SHARE = 0.85 #and some goals unassisted
+MAX_PLAY_PROBABILITY = 0.95 #even regular starters miss games through injury, suspension and rotation
+DEFAULT_PLAY_PROBABILITY = 0.5 #used when a player has no season minutes to go on
+
+
+def implied_probability(odds, default):
+    """
+    Takes an array of decimal odds and returns the implied probabilities,
+    using the default wherever the odds are missing (stored as -1 or NaN)
+    """
+    odds = np.asarray(odds, dtype=np.float64)
+    valid = np.isfinite(odds) & (odds > 1)
+    return np.where(valid, 1 / np.where(valid, odds, 2), default)
+
+def expected_match_goals(over_two_point_five_odds):
+    """
+    Takes an array of over 2.5 goals odds and returns the expected total goals in
+    each match, the Poisson mean that gives the implied chance of 3 or more goals
+    """
+    p_over = implied_probability(over_two_point_five_odds, np.nan)
+    missing = np.isnan(p_over)
+    p_over = np.clip(np.where(missing, 0.5, p_over), 0.05, 0.95)
+
+    #P(3 or more goals) rises with the mean so bisect every match at once
+    low = np.full(p_over.shape, 0.01)
+    high = np.full(p_over.shape, 10.0)
+    for _ in range(40):
+        mid = (low + high) / 2
+        p_mid = 1 - np.exp(-mid) * (1 + mid + mid ** 2 / 2)
+        low = np.where(p_mid < p_over, mid, low)
+        high = np.where(p_mid < p_over, high, mid)
+
+    return np.where(missing, DEFAULT_MATCH_GOALS, (low + high) / 2)
+
+def get_side_goal_rates(gameweek_predictions):
+    """
+    Takes gameweek predictions and works out the expected goals for each side of each fixture
+    from the odds in the player rows. Returns the expected goals per side and, for each player,
+    the index of their own side and of the opposition side
+    """
+    fixture_ids = gameweek_predictions['fixture_id'].to_numpy().astype(np.int64)
+    sides = gameweek_predictions['home_or_away_id'].to_numpy().astype(np.int64)
+
+    match_goals = expected_match_goals(gameweek_predictions['over_two_point_five_goals'].to_numpy())
+    win_probability = implied_probability(gameweek_predictions['win_odds'].to_numpy(), DEFAULT_WIN_PROBABILITY)
+    #a rough share of the match goals, half for an even game rising to 0.8 for a heavy favourite
+    goal_share = np.clip(0.25 + 0.75 * win_probability, 0.25, 0.8)
+
+    #home is side 1 and away is side 2, so 3 - side is the opposition
+    own_keys = fixture_ids * 4 + sides
+    opposition_keys = fixture_ids * 4 + (3 - sides)
+    side_keys, inverse = np.unique(np.concatenate([own_keys, opposition_keys]), return_inverse=True)
+    own_side = inverse[:len(own_keys)]
+    opposition_side = inverse[len(own_keys):]
+
+    #every player row gives an estimate for both sides of their fixture, so average them
+    estimates = np.concatenate([match_goals * goal_share, match_goals * (1 - goal_share)])
+    totals = np.bincount(inverse, weights=estimates, minlength=len(side_keys))
+    counts = np.bincount(inverse, minlength=len(side_keys))
+    side_goal_rates = totals / counts
+
+    return {'side_goal_rates': side_goal_rates, 'own_side': own_side, 'opposition_side': opposition_side}
+
+def get_play_probability(gameweek_predictions, clean_sheet_probability):
+    """
+    Takes gameweek predictions and each player's chance of a clean sheet and returns the chance each
+    player plays. It starts from their average minutes this season, or their recent points if they
+    have come into the side since, and is then held to the model: a player has to play to score more
+    than 4 points, and a goalkeeper or defender who plays gets there with a clean sheet alone, so
+    predicted_high_scorer is a floor for everyone and sets a ceiling for goalkeepers and defenders
+    """
+    season_minutes = gameweek_predictions['season_minutes'].to_numpy().astype(np.float64)
+    recent_points = gameweek_predictions['recent_points'].to_numpy().astype(np.float64)
+    high_scorer_probability = np.clip(gameweek_predictions['predicted_high_scorer'].to_numpy(), 0, 0.99)
+
+    #minutes and points are stored as -1 when the player has missing gameweeks
+    minutes_share = np.where(season_minutes < 0, DEFAULT_PLAY_PROBABILITY, season_minutes / 90)
+    recent_share = np.where(recent_points < 0, 0, recent_points / APPEARANCE_POINTS)
+    play_probability = np.clip(np.maximum(minutes_share, recent_share), 0, MAX_PLAY_PROBABILITY)
+
+    ceiling = high_scorer_probability / np.maximum(clean_sheet_probability, 1e-9)
+    play_probability = np.maximum(np.minimum(play_probability, ceiling), high_scorer_probability / 0.99)
+
+    #players without a fixture this gameweek don't play
+    blank = gameweek_predictions['fixture_id'].to_numpy() == -1
+    return np.where(blank, 0, np.clip(play_probability, 0, 1))
+
+def get_involvement_rates(gameweek_predictions, own_goal_rate, opposition_goal_rate, own_side):
+    """
+    Takes gameweek predictions and the expected goals for and against each player and returns the
+    chance each player plays and the chance each of their team's goals is scored or assisted by them
+    when they do. The rate is set so the chance of scoring more than 4 points matches the model's
+    predicted_high_scorer. That takes playing and one goal involvement for most players, or playing
+    and a clean sheet or one goal involvement for goalkeepers and defenders
+    """
+    position_ids = gameweek_predictions['position_id'].to_numpy()
+    high_scorer_probability = np.clip(gameweek_predictions['predicted_high_scorer'].to_numpy(), 0, 0.99)
+
+    #a clean sheet alone gets goalkeepers and defenders over 4 points
+    clean_sheet_probability = np.where(np.isin(position_ids, [1, 2]), np.exp(-opposition_goal_rate), 0)
+    play_probability = get_play_probability(gameweek_predictions, clean_sheet_probability)
+    #the chance of more than 4 points given they play
+    playing_high_scorer_probability = np.clip(high_scorer_probability / np.maximum(play_probability, 1e-9), 0, 0.99)
+    no_involvement_probability = np.clip((1 - playing_high_scorer_probability) / (1 - clean_sheet_probability), 1e-6, 1)
+    #goals are Poisson so P(no involvement) = exp(-goal rate * involvement rate)
+    involvement_rate = np.clip(-np.log(no_involvement_probability) / own_goal_rate, 0, 1)
+    involvement_rate[play_probability == 0] = 0
+
+    goal_fraction = np.array([GOAL_FRACTION.get(p, 0.5) for p in position_ids])
+    scorer_share = involvement_rate * goal_fraction
+    assist_share = involvement_rate * (1 - goal_fraction)
+
+    #a side's shares can't add up to more than all of its goals
+    n_sides = own_side.max() + 1
+    scorer_total = np.bincount(own_side, weights=scorer_share, minlength=n_sides)
+    assist_total = np.bincount(own_side, weights=assist_share, minlength=n_sides)
+    scorer_share *= np.minimum(1, MAX_SCORER_SHARE / np.maximum(scorer_total, 1e-9))[own_side]
+    assist_share *= np.minimum(1, MAX_ASSIST_SHARE / np.maximum(assist_total, 1e-9))[own_side]
+
+    return {'play_probability': play_probability, 'scorer_share': scorer_share, 'assist_share': assist_share}
+
+def allocate_goal_events(side_goals, own_side, shares, rng):
+    """
+    Takes the sampled goals for each side, each player's side and the share of their side's goals
+    that go to them, and picks who gets each goal in every sample. Every goal is one event so the
+    work grows with the number of goals rather than players times samples. Returns the player and
+    sample index of every goal that went to a player in the pool
+    """
+    n_sides, n_samples = side_goals.shape
+
+    #goal events, one per goal, each tagged with its side and sample
+    goals_per_cell = side_goals.ravel()
+    event_side = np.repeat(np.repeat(np.arange(n_sides), n_samples), goals_per_cell)
+    event_sample = np.repeat(np.tile(np.arange(n_samples), n_sides), goals_per_cell)
+
+    #lay every side's players out on [side, side + 1) by their cumulative share, so a goal from
+    #side s with uniform draw u lands on the player whose slice covers s + u, or nobody
+    order = np.argsort(own_side, kind='stable')
+    sorted_sides = own_side[order]
+    cumulative_share = np.cumsum(shares[order])
+    side_starts = np.concatenate([[0], cumulative_share])[np.searchsorted(sorted_sides, np.arange(n_sides))]
+    boundaries = sorted_sides + cumulative_share - side_starts[sorted_sides]
+
+    landing = np.searchsorted(boundaries, event_side + rng.random(len(event_side)), side='right')
+    in_pool = landing < len(order)
+    in_pool[in_pool] = sorted_sides[landing[in_pool]] == event_side[in_pool]
+
+    return {'player': order[landing[in_pool]], 'sample': event_sample[in_pool]}
+
+def summarise_points(points):
+    """
+    Takes an array of points samples, one row per player, and returns each player's mean,
+    standard deviation, 10th/50th/90th percentiles and the chance of more than 4 points and of a
+    haul. Points are small integers so everything comes from one count of each score per player
+    """
+    n_players, n_samples = points.shape
+    lowest = int(points.min())
+    n_values = int(points.max()) - lowest + 1
+    counts = np.stack([np.bincount(player_points, minlength=n_values) for player_points in points - lowest])
+    values = np.arange(n_values) + lowest
+
+    probabilities = counts / n_samples
+    mean = probabilities @ values
+    cumulative = counts.cumsum(axis=1)
+    quantiles = [values[np.argmax(cumulative >= q * n_samples, axis=1)] for q in (0.1, 0.5, 0.9)]
+
+    return {
+        'mean': mean,
+        'std': np.sqrt(np.maximum(probabilities @ values ** 2 - mean ** 2, 0)),
+        'p10': quantiles[0],
+        'p50': quantiles[1],
+        'p90': quantiles[2],
+        'over_four': probabilities[:, values > 4].sum(axis=1),
+        'haul': probabilities[:, values >= HAUL_POINTS].sum(axis=1),
+    }
+
+def simulate_gameweek_points(gameweek_predictions, n_samples=N_SAMPLES, seed=None):
+    """
+    Takes the dataframe from make_gameweek_predictions and simulates the gameweek n_samples times.
+    Goals for every side of every fixture are drawn from the odds and shared out as goals and assists
+    between that side's players. Each player plays with a chance taken from their minutes and gets a
+    share set from the model's predicted_high_scorer, and only scores in the samples where they play.
+    Points follow FPL scoring by position, so players on the same team move together and a
+    defender's clean sheet depends on the same sampled goals as the opposing forwards. Returns the
+    points samples (one row per player) and a dataframe summarising each player's points distribution
+    and captaincy value
+    """
+    rng = np.random.default_rng(seed)
+    n_players = len(gameweek_predictions)
+    position_ids = gameweek_predictions['position_id'].to_numpy()
+
+    side_info = get_side_goal_rates(gameweek_predictions)
+    side_goal_rates = side_info['side_goal_rates']
+    own_side = side_info['own_side']
+    opposition_side = side_info['opposition_side']
+
+    #team outcomes, one row per side of each fixture
+    side_goals = rng.poisson(side_goal_rates[:, None], size=(len(side_goal_rates), n_samples)).astype(np.int16)
+
+    rates = get_involvement_rates(gameweek_predictions, side_goal_rates[own_side], side_goal_rates[opposition_side], own_side)
+    #16 bit draws are plenty of resolution for a chance of playing and half the work of floats
+    play_thresholds = np.round(rates['play_probability'] * 65535).astype(np.uint16)
+    plays = rng.integers(0, 65535, size=(n_players, n_samples), dtype=np.uint16) < play_thresholds[:, None]
+    goals = allocate_goal_events(side_goals, own_side, rates['scorer_share'], rng)
+    assists = allocate_goal_events(side_goals, own_side, rates['assist_share'], rng)
+
+    #appearance, clean sheet and goals conceded points depend only on position and the opposition's
+    #goals, so work them out once per position and side then look up each player's row
+    positions = np.unique(position_ids)
+    result_points = np.stack([
+        APPEARANCE_POINTS
+        + np.where(side_goals == 0, CLEAN_SHEET_POINTS.get(p, 0), 0)
+        - (side_goals // 2 if p in CONCEDED_PENALTY_POSITIONS else 0)
+        for p in positions
+    ]).astype(np.int16).reshape(-1, n_samples)
+    points = result_points[np.searchsorted(positions, position_ids) * len(side_goal_rates) + opposition_side]
+
+    #then goal and assist points land on each player's sample
+    goal_points = np.array([GOAL_POINTS.get(p, 4) for p in position_ids], dtype=np.int16)
+    np.add.at(points.reshape(-1), goals['player'] * n_samples + goals['sample'], goal_points[goals['player']])
+    np.add.at(points.reshape(-1), assists['player'] * n_samples + assists['sample'], np.int16(ASSIST_POINTS))
+
+    #players score nothing in the samples where they don't play, goals that went to them included
+    points *= plays
+
+    stats = summarise_points(points)
+
+    #captaincy from the joint samples: how often each player is the top scorer (sharing ties)
+    #and how often they outscore the player with the highest expected points
+    top_score = points.max(axis=0)
+    is_top_scorer = points == top_score
+    top_scorer_share = (1 / is_top_scorer.sum(axis=0)).astype(np.float32)
+    favourite = np.argmax(stats['mean'])
+    beats_favourite = np.count_nonzero(points > points[favourite], axis=1) / n_samples
+
+    summary = pd.DataFrame({
+        'player_name': gameweek_predictions['player_name'].to_numpy(),
+        'opposition_name': gameweek_predictions['opposition_name'].to_numpy(),
+        'position_id': position_ids,
+        'predicted_high_scorer': gameweek_predictions['predicted_high_scorer'].to_numpy(),
+        'play_probability': rates['play_probability'],
+        'expected_points': stats['mean'],
+        'points_std': stats['std'],
+        'points_p10': stats['p10'],
+        'points_p50': stats['p50'],
+        'points_p90': stats['p90'],
+        'simulated_high_scorer': stats['over_four'],
+        'haul_probability': stats['haul'],
+        'top_scorer_probability': is_top_scorer.astype(np.float32) @ top_scorer_share / n_samples,
+        'beats_favourite_probability': beats_favourite,
+    })
+    summary = summary.sort_values(by='expected_points', ascending=False)
+
+    return {'samples': points, 'summary': summary}